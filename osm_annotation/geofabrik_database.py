@@ -1,6 +1,7 @@
 import os
 import sys
 import time
+import json
 from glob import glob
 import requests
 import zipfile
@@ -8,11 +9,14 @@ import shutil
 from tqdm import tqdm
 import pkg_resources
 
+import numpy as np
 import pandas as pd
 import geopandas as gpd
 import shapely
 import warnings
 
+from osm_annotation import index_snapshot
+
 warnings.filterwarnings("ignore")
 
 """
@@ -25,6 +29,9 @@ label_map_path = pkg_resources.resource_filename('osm_annotation', 'label_map/os
 state_string = "alabama, alaska, arizona, arkansas, norcal, socal, colorado, connecticut, delaware, district of columbia, florida, georgia, hawaii, idaho, illinois, indiana, iowa, kansas, kentucky, louisiana, maine, maryland, massachusetts, michigan, minnesota, mississippi, missouri, montana, nebraska, nevada, new hampshire, new jersey, new mexico, new york, north carolina, north dakota, ohio, oklahoma, oregon, pennsylvania, puerto rico, rhode island, south carolina, south dakota, tennessee, texas, united states virgin islands, utah, vermont, virginia, washington, west virginia, wisconsin, wyoming"
 state_list = state_string.split(", ")
 
+# annotation index snapshot
+write_index_snapshot = True  # if True, write a memory-mapped snapshot of the annotation index at the end of build().
+
 # OSM related
 base_url = "http://download.geofabrik.de/north-america/us/"
 layers = ["buildings", "landuse", "natural", "places", "pofw", "pois", "railways", "roads", "traffic", "transport",
@@ -407,9 +414,140 @@ def _rearrange_shapefiles(organized_data_folder_path, combined_data_folder_path)
     print("Runtime of the program is {} min".format((end_time - start_time) / 60))
 
 
+def _collect_index_points(combined_data_folder_path):
+    """collect all POIs of the combined database as projected coordinates with label codes.
+    Polygon POIs are represented by their centroids, the same as in SemanticAnnotator.annotate_batch_points.
+
+    Parameters:
+       combined_data_folder_path (file path): the folder of combined shapefiles
+    Returns:
+       x (float64 array), y (float64 array), codes (int32 array), label_list
+    """
+    label_list = []
+    x_parts = []
+    y_parts = []
+    code_parts = []
+
+    for lvl1_label in tqdm(sorted(os.listdir(combined_data_folder_path))):
+        lvl1_path = os.path.join(combined_data_folder_path, lvl1_label)
+        for lvl2_label in sorted(os.listdir(lvl1_path)):
+            lvl2_path = os.path.join(lvl1_path, lvl2_label)
+            for lvl3_label in sorted(os.listdir(lvl2_path)):
+                lvl3_path = os.path.join(lvl2_path, lvl3_label)
+                for category in ["point", "polygon"]:
+                    finding_list = list(glob(os.path.join(lvl3_path, "*_" + category + ".shp")))
+                    if len(finding_list) == 0:
+                        continue
+
+                    gdf_landmark = gpd.read_file(finding_list[0])
+                    gdf_landmark = gdf_landmark.to_crs('epsg:2163')
+                    if category == "polygon":
+                        gdf_landmark.geometry = gdf_landmark.geometry.centroid
+                    gdf_landmark = gdf_landmark[gdf_landmark.geometry.notna() & ~gdf_landmark.geometry.is_empty]
+                    if gdf_landmark.shape[0] == 0:
+                        continue
+
+                    code = len(label_list)
+                    label_list.append("{};{};{} ({})".format(lvl1_label, lvl2_label, lvl3_label, category))
+                    x_parts.append(gdf_landmark.geometry.x.to_numpy(dtype=np.float64))
+                    y_parts.append(gdf_landmark.geometry.y.to_numpy(dtype=np.float64))
+                    code_parts.append(np.full(gdf_landmark.shape[0], code, dtype=np.int32))
+
+    if len(label_list) == 0:
+        return np.empty(0, dtype=np.float64), np.empty(0, dtype=np.float64), np.empty(0, dtype=np.int32), label_list
+    return np.concatenate(x_parts), np.concatenate(y_parts), np.concatenate(code_parts), label_list
+
+
+def _write_index_snapshot(combined_data_folder_path, index_folder_path):
+    """write a versioned binary snapshot of the annotation index, to be opened by SemanticAnnotator with numpy.memmap.
+    POIs are bucketed into square tiles and stored in tile order, so a tile is a contiguous slice of the arrays.
+    The file layout is described in index_snapshot.py.
+
+    Parameters:
+       combined_data_folder_path (file path): the folder of combined shapefiles
+       index_folder_path (file path): the folder to write the snapshot to
+    Returns:
+       None
+    """
+
+    print("======================================================================================================")
+    print("Start writing the annotation index snapshot to {}".format(index_folder_path))
+    start_time = time.time()
+
+    source_fingerprint = index_snapshot.get_source_fingerprint(combined_data_folder_path)
+    x, y, codes, label_list = _collect_index_points(combined_data_folder_path)
+
+    tile_size = float(index_snapshot.tile_size)
+    if x.shape[0] > 0:
+        col = np.floor(x / tile_size).astype(np.int64)
+        row = np.floor(y / tile_size).astype(np.int64)
+        col_min, row_min = int(col.min()), int(row.min())
+        n_cols, n_rows = int(col.max()) - col_min + 1, int(row.max()) - row_min + 1
+        keys = (col - col_min) * n_rows + (row - row_min)
+    else:
+        col_min, row_min, n_cols, n_rows = 0, 0, 0, 0
+        keys = np.empty(0, dtype=np.int64)
+
+    order = np.argsort(keys, kind="stable")
+    keys = keys[order]
+    tile_keys, tile_starts = np.unique(keys, return_index=True)
+    tile_offsets = np.append(tile_starts, keys.shape[0])
+
+    arrays = {"x": x[order],
+              "y": y[order],
+              "codes": codes[order],
+              "tile_keys": tile_keys,
+              "tile_offsets": tile_offsets}
+
+    # write into a temporary folder first so that running annotators never open a half-written snapshot
+    tmp_folder_path = index_folder_path + ".tmp"
+    if os.path.exists(tmp_folder_path):
+        shutil.rmtree(tmp_folder_path)
+    _create_folder(tmp_folder_path)
+
+    header = {"version": index_snapshot.version,
+              "crs": index_snapshot.crs,
+              "source_fingerprint": source_fingerprint,
+              "n_points": int(x.shape[0]),
+              "n_tiles": int(tile_keys.shape[0]),
+              "tile_size": tile_size,
+              "col_min": col_min,
+              "row_min": row_min,
+              "n_cols": n_cols,
+              "n_rows": n_rows,
+              "arrays": {},
+              "labels": label_list}
+    for name, array in arrays.items():
+        file_name = name + ".bin"
+        dtype = index_snapshot.array_dtypes[name]
+        array.astype(dtype).tofile(os.path.join(tmp_folder_path, file_name))
+        header["arrays"][name] = {"file": file_name, "dtype": dtype, "length": int(array.shape[0])}
+    with open(os.path.join(tmp_folder_path, index_snapshot.header_name), 'w') as fp:
+        json.dump(header, fp)
+
+    # move the live snapshot aside before moving the new one in, and delete it only afterwards,
+    # so the gap without a snapshot is two renames and open memory maps keep their files
+    old_folder_path = index_folder_path + ".old"
+    if os.path.exists(old_folder_path):
+        shutil.rmtree(old_folder_path)
+    if os.path.exists(index_folder_path):
+        os.replace(index_folder_path, old_folder_path)
+    os.replace(tmp_folder_path, index_folder_path)
+    if os.path.exists(old_folder_path):
+        shutil.rmtree(old_folder_path)
+
+    end_time = time.time()
+    print("End:  {} POIs of {} labels in {} tiles".format(header["n_points"], len(label_list), header["n_tiles"]))
+    print("Runtime is {} min".format((end_time - start_time) / 60))
+    print("")
+    return
+
+
 def build(database_folder_path):
     """builds a local database of Geofabrik shapefiles in designated folder path.
     The file system follows the structure in the user-specified label hierarchy.
+    If write_index_snapshot is True, a memory-mapped snapshot of the annotation index is written to the "poi_index" folder,
+    and rewritten whenever the combined shapefiles change.
 
     Parameters:
        database_folder_path (file path): the local file path to store Geofabrik shapefiles
@@ -421,6 +559,7 @@ def build(database_folder_path):
     unzipped_folder_path = os.path.join(database_folder_path, "unzipped")
     organized_data_folder_path = os.path.join(database_folder_path, "organized_landmarks")
     combined_data_folder_path = os.path.join(database_folder_path, "organized_landmarks_combined")
+    index_folder_path = os.path.join(database_folder_path, index_snapshot.folder_name)
 
     if update_shapefiles:  # delete all databases
         if os.path.exists(download_folder_path):
@@ -431,11 +570,17 @@ def build(database_folder_path):
             shutil.rmtree(organized_data_folder_path)
         if os.path.exists(combined_data_folder_path):
             shutil.rmtree(combined_data_folder_path)
+        if os.path.exists(index_folder_path):
+            shutil.rmtree(index_folder_path)
 
     _download_and_unzip(download_folder_path, unzipped_folder_path)
     map_dict = _parse_label_map()
     _reorganize_shapefiles(map_dict, organized_data_folder_path, unzipped_folder_path)
     _rearrange_shapefiles(organized_data_folder_path, combined_data_folder_path)
+    if write_index_snapshot and \
+            not index_snapshot.is_current(index_folder_path, index_snapshot.read_header(index_folder_path),
+                                          combined_data_folder_path):
+        _write_index_snapshot(combined_data_folder_path, index_folder_path)
 
     return
 
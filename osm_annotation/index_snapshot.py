@@ -0,0 +1,83 @@
+import os
+import json
+import hashlib
+
+"""
+Layout of the annotation index snapshot, shared by geofabrik_database.py (writer) and semantic_annotation.py (reader).
+Kept free of heavy imports so that opening a snapshot stays fast.
+
+Files in the snapshot folder:
+   x.bin, y.bin: POI coordinates in EPSG:2163 (little-endian float64)
+   codes.bin: label code of each POI, an index into "labels" in the header (little-endian int32)
+   tile_keys.bin: sorted keys of non-empty tiles, key = column * n_rows + row (little-endian int64)
+   tile_offsets.bin: start of each tile in the POI arrays, plus the total count (little-endian int64)
+   header.json: version, tile grid, labels and the fingerprint of the source shapefiles.
+      Written last, a snapshot without header is incomplete.
+"""
+
+folder_name = "poi_index"
+header_name = "header.json"
+version = 1  # bump whenever the snapshot layout changes; older snapshots are then ignored.
+tile_size = 1000  # edge length of a snapshot tile, in meters (EPSG:2163)
+crs = "epsg:2163"
+array_dtypes = {"x": "<f8",
+                "y": "<f8",
+                "codes": "<i4",
+                "tile_keys": "<i8",
+                "tile_offsets": "<i8"}
+
+
+def read_header(index_folder_path):
+    """read the header of the snapshot in index_folder_path.
+
+    Returns:
+       the header dict, or None if the snapshot is missing or incomplete
+    """
+    header_path = os.path.join(index_folder_path, header_name)
+    if not os.path.exists(header_path):
+        return None
+    with open(header_path) as fp:
+        return json.load(fp)
+
+
+def get_source_fingerprint(combined_data_folder_path):
+    """fingerprint of the combined shapefiles a snapshot is built from: relative path, size and mtime of every file.
+
+    Returns:
+       a hex digest, or None if the folder does not exist
+    """
+    if not os.path.isdir(combined_data_folder_path):
+        return None
+    entry_list = []
+    for dir_path, _, file_names in os.walk(combined_data_folder_path):
+        for file_name in file_names:
+            file_path = os.path.join(dir_path, file_name)
+            file_stat = os.stat(file_path)
+            entry_list.append("{}|{}|{}".format(os.path.relpath(file_path, combined_data_folder_path),
+                                                file_stat.st_size, file_stat.st_mtime_ns))
+    return hashlib.sha1("\n".join(sorted(entry_list)).encode("utf-8")).hexdigest()
+
+
+def is_complete(index_folder_path, header):
+    """check that a snapshot has the current version and all its array files with the expected sizes.
+    Used by SemanticAnnotator; it does not look at the combined shapefiles, see is_current.
+    """
+    if header is None or header.get("version") != version:
+        return False
+    for name, dtype in array_dtypes.items():
+        spec = header.get("arrays", {}).get(name)
+        if spec is None:
+            return False
+        file_path = os.path.join(index_folder_path, spec["file"])
+        if not os.path.exists(file_path) or os.path.getsize(file_path) != spec["length"] * int(dtype[2:]):
+            return False
+    return True
+
+
+def is_current(index_folder_path, header, combined_data_folder_path):
+    """check that a snapshot is complete and was built from the current combined shapefiles.
+    Used by geofabrik_database.build to decide whether the snapshot has to be rewritten.
+    """
+    if not is_complete(index_folder_path, header):
+        return False
+    return header.get("source_fingerprint") == get_source_fingerprint(combined_data_folder_path)
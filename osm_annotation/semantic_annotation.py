@@ -1,6 +1,10 @@
 import os
 import sys
+import functools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from glob import glob
+import numpy as np
 import pandas as pd
 from shapely.geometry import shape
 import fiona
@@ -8,11 +12,12 @@ from shapely.geometry.polygon import Polygon
 from gps2space import geodf, dist
 import geopandas as gpd
 from tqdm import tqdm
+from osm_annotation import index_snapshot
 
 """
 The SemanticAnnotator class aims to annotate location data using geofabrik database created by geofabrik_database.py. 
 
-There are three annotation methods:
+There are four annotation methods:
     1. annotate_single_point(lat, lon): annotate single point with semantic labels from OpenStreetMap database.
         - pro: return distances to all POI types 
         - con: time-consuming (~2 hours/query). Method 3 is recommended for batch of points. 
@@ -22,6 +27,15 @@ There are three annotation methods:
     3. annotate_batch_points(dataframe, latitude_colname, longitude_colname): annotate a batch of points (usually centroids of places) with semantic labels from OpenStreetMap database.
         - pro: fastest method. Fit for annotating many centroids of places simultaneously. 
         - con: just return the label of the nearest POI and the distance.   
+    4. annotate_trajectory(dataframe, latitude_colname, longitude_colname, time_colname, user_colname): annotate time-ordered GPS traces.
+        - pro: stays are annotated once and consecutive fixes reuse nearby candidate POIs, so few spatial queries are needed.
+        - con: stay fixes share the label and distance of their stay point.
+
+If geofabrik_database.build has written an index snapshot ("poi_index" folder), methods 1 and 3 query the snapshot,
+which is opened with numpy.memmap: startup is nearly instant, and processes on the same host share the mapped pages.
+Method 2 needs the full POI geometries and always reads the shapefiles.
+When reading shapefiles, SemanticAnnotator(database_folder_path, max_workers=n) reads and processes up to 2 * n upcoming
+POI categories in a thread pool. Results are collected in the same order as the serial mode (max_workers=1).
     
 This script uses the geodf and dist functions from the GPS2space package (https://gps2space.readthedocs.io/en/latest/).
     
@@ -29,8 +43,227 @@ This script uses the geodf and dist functions from the GPS2space package (https:
 
 
 class SemanticAnnotator:
-    def __init__(self, database_folder_path):
+    def __init__(self, database_folder_path, use_index_snapshot=True, max_workers=1):
         self.geofabrik_combined_folder_path = os.path.join(database_folder_path, "organized_landmarks_combined")
+        if max_workers is None:  # the default of concurrent.futures.ThreadPoolExecutor
+            max_workers = min(32, (os.cpu_count() or 1) + 4)
+        if max_workers < 1:
+            raise ValueError("max_workers must be a positive integer or None, got {}".format(max_workers))
+        self.max_workers = max_workers
+        self.index_snapshot = None
+        if use_index_snapshot:
+            self.index_snapshot = self._open_index_snapshot(
+                os.path.join(database_folder_path, index_snapshot.folder_name))
+
+    def _open_index_snapshot(self, index_folder_path):
+        """open the annotation index snapshot written by geofabrik_database.build.
+        The arrays are mapped read-only with numpy.memmap, so nothing is read until it is queried.
+
+        Parameters:
+           index_folder_path (file path): the folder of the index snapshot
+        Returns:
+           a dict with the header, the labels and the mapped arrays, or None if there is no usable snapshot
+        """
+        header = index_snapshot.read_header(index_folder_path)
+        if header is None:
+            return None
+        if not index_snapshot.is_complete(index_folder_path, header):
+            print("Index snapshot in {} is incomplete or has another version, fall back to shapefiles. "
+                  "Run geofabrik_database.build to rewrite it.".format(index_folder_path))
+            return None
+
+        snapshot = {"header": header, "labels": header["labels"]}
+        for name, spec in header["arrays"].items():
+            if spec["length"] == 0:  # numpy.memmap cannot map an empty file
+                snapshot[name] = np.empty(0, dtype=spec["dtype"])
+            else:
+                snapshot[name] = np.memmap(os.path.join(index_folder_path, spec["file"]), dtype=spec["dtype"],
+                                           mode='r', shape=(spec["length"],))
+        return snapshot
+
+    def _get_snapshot_tile(self, x, y):
+        header = self.index_snapshot["header"]
+        col = int(np.floor(x / header["tile_size"])) - header["col_min"]
+        row = int(np.floor(y / header["tile_size"])) - header["row_min"]
+        return col, row
+
+    def _get_snapshot_ring_candidates(self, col, row, r):
+        """indices of the snapshot POIs in the ring of tiles at Chebyshev distance r around tile (col, row)."""
+        header = self.index_snapshot["header"]
+        if r == 0:
+            cols = np.array([col])
+            rows = np.array([row])
+        else:
+            span = np.arange(-r, r + 1)
+            side = np.arange(-r + 1, r)
+            cols = col + np.concatenate([span, span, np.full(side.shape, -r), np.full(side.shape, r)])
+            rows = row + np.concatenate([np.full(span.shape, -r), np.full(span.shape, r), side, side])
+        inside = (cols >= 0) & (cols < header["n_cols"]) & (rows >= 0) & (rows < header["n_rows"])
+        keys = cols[inside] * header["n_rows"] + rows[inside]
+
+        tile_keys = self.index_snapshot["tile_keys"]
+        tile_offsets = self.index_snapshot["tile_offsets"]
+        pos = np.searchsorted(tile_keys, keys)
+        found = pos < tile_keys.shape[0]
+        pos = pos[found]
+        pos = pos[tile_keys[pos] == keys[found]]
+        if pos.shape[0] == 0:
+            return np.empty(0, dtype=np.int64)
+        return np.concatenate([np.arange(tile_offsets[p], tile_offsets[p + 1]) for p in pos])
+
+    def _find_snapshot_nearest_poi(self, x, y, max_rings=64):
+        """find the nearest POI in the index snapshot by searching rings of tiles around the query point.
+
+        Parameters:
+           x (float): x of the query point, in EPSG:2163
+           y (float): y of the query point, in EPSG:2163
+           max_rings (int): number of rings to search before scanning the whole snapshot
+        Returns:
+           (matched label, distance in meters), or (None, inf) if the snapshot is empty
+        """
+        snapshot = self.index_snapshot
+        header = snapshot["header"]
+        if header["n_points"] == 0:
+            return None, np.inf
+
+        col, row = self._get_snapshot_tile(x, y)
+        r_cover = max(col, header["n_cols"] - 1 - col, row, header["n_rows"] - 1 - row)  # ring reaching all tiles
+        best_idx, best_dist = -1, np.inf
+        for r in range(min(r_cover, max_rings) + 1):
+            idx = self._get_snapshot_ring_candidates(col, row, r)
+            if idx.shape[0] > 0:
+                d = np.hypot(snapshot["x"][idx] - x, snapshot["y"][idx] - y)
+                i = int(np.argmin(d))
+                if d[i] < best_dist:
+                    best_idx, best_dist = idx[i], d[i]
+            if best_dist <= r * header["tile_size"]:  # POIs outside ring r are at least r tiles away
+                break
+        else:
+            if r_cover > max_rings:  # far away from all POIs, scan the whole snapshot
+                d = np.hypot(snapshot["x"] - x, snapshot["y"] - y)
+                best_idx = int(np.argmin(d))
+                best_dist = d[best_idx]
+
+        return snapshot["labels"][int(snapshot["codes"][best_idx])], float(best_dist)
+
+    def _get_snapshot_distances_to_pois(self, x, y):
+        """distances from the query point (EPSG:2163) to the nearest POI of every label in the index snapshot."""
+        snapshot = self.index_snapshot
+        d = np.hypot(snapshot["x"] - x, snapshot["y"] - y)
+        dist_series = pd.Series(d).groupby(np.asarray(snapshot["codes"])).min()
+        return {snapshot["labels"][code]: float(dist) for code, dist in dist_series.items()}
+
+    def _get_snapshot_candidates_within(self, x, y, radius, max_rings=64):
+        """indices of the snapshot POIs in all tiles that intersect the disk of the radius around the query point.
+
+        Returns:
+           an index array, or None if the disk spans more than max_rings rings of tiles
+        """
+        header = self.index_snapshot["header"]
+        n_rings = int(radius // header["tile_size"]) + 1
+        if n_rings > max_rings:
+            return None
+        col, row = self._get_snapshot_tile(x, y)
+        return np.concatenate([self._get_snapshot_ring_candidates(col, row, r) for r in range(n_rings + 1)])
+
+    def _detect_stay_points(self, x, y, seconds, stay_radius, min_stay_duration):
+        """detect stay points in a single time-ordered track.
+        A stay is a maximal run of fixes that remain within stay_radius of its first fix for at least min_stay_duration.
+
+        Parameters:
+           x, y (float arrays): coordinates of the fixes, in EPSG:2163
+           seconds (float array): time of the fixes, in seconds
+           stay_radius (float): in meters
+           min_stay_duration (float): in seconds
+        Returns:
+           stay_idx (int array, -1 for moving fixes), stay_points (list of (x, y) centroids of the stays)
+        """
+        n = x.shape[0]
+        stay_idx = np.full(n, -1, dtype=np.int64)
+        stay_points = []
+        i = 0
+        while i < n:
+            # j is the first fix after i that leaves the stay radius, searched in doubling windows
+            j = n
+            start = i + 1
+            window = 64
+            while start < n:
+                end = min(start + window, n)
+                leaves = np.hypot(x[start:end] - x[i], y[start:end] - y[i]) > stay_radius
+                if leaves.any():
+                    j = start + int(np.argmax(leaves))
+                    break
+                start = end
+                window *= 2
+            if seconds[j - 1] - seconds[i] >= min_stay_duration:
+                stay_idx[i:j] = len(stay_points)
+                stay_points.append((float(np.mean(x[i:j])), float(np.mean(y[i:j]))))
+                i = j
+            else:
+                i += 1
+        return stay_idx, stay_points
+
+    def _list_categories(self):
+        """list all level3 landmarks of the database as (label, shapefile path, geometry type), point before polygon."""
+        category_list = []
+        for lvl1_label in os.listdir(self.geofabrik_combined_folder_path):
+            lvl1_path = self.geofabrik_combined_folder_path + os.sep + lvl1_label
+            for lvl2_label in os.listdir(lvl1_path):
+                lvl2_path = lvl1_path + os.sep + lvl2_label
+                for lvl3_label in os.listdir(lvl2_path):
+                    lvl3_path = lvl2_path + os.sep + lvl3_label
+                    for geometry_type in ["point", "polygon"]:
+                        finding_list = list(glob(os.path.join(lvl3_path, "*_" + geometry_type + ".shp")))
+                        if len(finding_list) > 0:
+                            osm_label = "{};{};{} ({})".format(lvl1_label, lvl2_label, lvl3_label, geometry_type)
+                            category_list.append((osm_label, finding_list[0], geometry_type))
+        return category_list
+
+    def _map_categories(self, func):
+        """apply func(label, shapefile path, geometry type) to all level3 landmarks and yield the results in order.
+        With max_workers > 1, the next categories are read and processed in a bounded thread pool
+            while the results of the earlier ones are consumed.
+        """
+        category_list = self._list_categories()
+        if self.max_workers <= 1:
+            for category in tqdm(category_list):
+                yield func(*category)
+            return
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            category_iter = iter(category_list)
+            pending = deque()
+            for category in category_iter:  # keep at most 2 * max_workers categories in flight
+                pending.append(executor.submit(func, *category))
+                if len(pending) >= 2 * self.max_workers:
+                    break
+            for _ in tqdm(range(len(category_list))):
+                result = pending.popleft().result()
+                category = next(category_iter, None)
+                if category is not None:
+                    pending.append(executor.submit(func, *category))
+                yield result
+
+    def _get_category_distances(self, query_point, osm_label, shp_path, geometry_type):
+        """distances from the query points to the nearest POI of one category. Polygon POIs are reduced to centroids."""
+        gdf_landmark = gpd.read_file(shp_path)
+        if geometry_type == "polygon":
+            gdf_landmark = gdf_landmark.to_crs('epsg:2163')
+            gdf_landmark.geometry = gdf_landmark.geometry.centroid
+
+        nearest_POI = dist.dist_to_point(query_point, gdf_landmark, proj=2163)
+        return osm_label, nearest_POI["dist2point"]
+
+    def _find_category_in_shape(self, cluster_poly, osm_label, shp_path, geometry_type):
+        """find the first POI of one category within (point) or intersecting (polygon) the query shape."""
+        with fiona.open(shp_path) as gdf_landmark:
+            for next_shp in gdf_landmark:
+                geo = shape(next_shp['geometry'])
+                if geometry_type == "point" and cluster_poly.contains(geo):  # polygon contains a point landmark
+                    return osm_label, geo
+                if geometry_type == "polygon" and cluster_poly.intersects(geo):  # polygon intersects a polygon landmark
+                    return osm_label, geo
+        return osm_label, None
 
     def _get_shapely_poly(self, lat_list, lon_list):
         cluster_poly = Polygon([(x, y) for x, y in zip(lon_list, lat_list)])  # list of (longitude, latitude)
@@ -57,40 +290,18 @@ class SemanticAnnotator:
         df_centroid_point = pd.DataFrame(data=centroid, columns=['longitude', 'latitude'])
         cluster_centroid_point = geodf.df_to_gdf(df_centroid_point, x='longitude', y='latitude')
 
-        # iterate through all level3 landmarks and find associated labels (lvl1, lvl2, lvl3)
-
-        for lvl1_label in tqdm(os.listdir(self.geofabrik_combined_folder_path)):
-            # print("Level 1 : "+lvl1_label)
-            lvl1_path = self.geofabrik_combined_folder_path + os.sep + lvl1_label
-            for lvl2_label in os.listdir(lvl1_path):
-                # print("  Level 2 : "+lvl2_label)
-                lvl2_path = lvl1_path + os.sep + lvl2_label
-                for lvl3_label in os.listdir(lvl2_path):
-                    # print("    Level 3 : "+lvl3_label)
-                    lvl3_path = lvl2_path + os.sep + lvl3_label
-
-                    finding_list_point = list(glob(os.path.join(lvl3_path, "*_point.shp")))
-                    if len(finding_list_point) > 0:
-                        point_shp_path = finding_list_point[0]
-                        gdf_landmark = gpd.read_file(point_shp_path)
-
-                        nearest_POI = dist.dist_to_point(cluster_centroid_point, gdf_landmark, proj=2163)
-                        distance = list(nearest_POI['dist2point'])[0]
-                        distance_list.append(distance)
-                        osm_label_list.append("{};{};{} (point)".format(lvl1_label, lvl2_label, lvl3_label))
-
-                    finding_list_poly = list(glob(os.path.join(lvl3_path, "*_polygon.shp")))
-                    if len(finding_list_poly) > 0:
-                        poly_shp_path = finding_list_poly[0]
-
-                        gdf_landmark = gpd.read_file(poly_shp_path)
-                        gdf_landmark = gdf_landmark.to_crs('epsg:2163')
-                        gdf_landmark.geometry = gdf_landmark.geometry.centroid
-
-                        nearest_POI = dist.dist_to_point(cluster_centroid_point, gdf_landmark, proj=2163)
-                        distance = list(nearest_POI['dist2point'])[0]
-                        distance_list.append(distance)
-                        osm_label_list.append("{};{};{} (polygon)".format(lvl1_label, lvl2_label, lvl3_label))
+        if self.index_snapshot is not None:
+            cluster_centroid_point_p = cluster_centroid_point.to_crs('epsg:2163')
+            distances_to_pois = self._get_snapshot_distances_to_pois(cluster_centroid_point_p.geometry.x[0],
+                                                                     cluster_centroid_point_p.geometry.y[0])
+            osm_label_list = list(distances_to_pois.keys())
+            distance_list = list(distances_to_pois.values())
+        else:
+            # iterate through all level3 landmarks and find associated labels (lvl1, lvl2, lvl3)
+            for osm_label, distances in self._map_categories(
+                    functools.partial(self._get_category_distances, cluster_centroid_point)):
+                osm_label_list.append(osm_label)
+                distance_list.append(list(distances)[0])
 
         min_idx = distance_list.index(min(distance_list))
         min_distance = min(distance_list)
@@ -130,40 +341,14 @@ class SemanticAnnotator:
         geo_list = []
 
         # iterate through all level3 landmarks and find associated labels (lvl1, lvl2, lvl3)
-
-        for lvl1_label in tqdm(os.listdir(self.geofabrik_combined_folder_path)):
-            # print("Level 1 : "+lvl1_label)
-            lvl1_path = self.geofabrik_combined_folder_path + os.sep + lvl1_label
-            for lvl2_label in os.listdir(lvl1_path):
-                # print("  Level 2 : "+lvl2_label)
-                lvl2_path = lvl1_path + os.sep + lvl2_label
-                for lvl3_label in os.listdir(lvl2_path):
-                    # print("    Level 3 : "+lvl3_label)
-                    lvl3_path = lvl2_path + os.sep + lvl3_label
-
-                    finding_list_point = list(glob(os.path.join(lvl3_path, "*_point.shp")))
-                    if len(finding_list_point) > 0:
-                        point_shp_path = finding_list_point[0]
-                        gdf_landmark_point = fiona.open(point_shp_path)
-
-                        for next_shp in gdf_landmark_point:
-                            geo = shape(next_shp['geometry'])
-                            if cluster_poly.contains(geo):  # polygon contains a point landmark
-                                point_label_list.append("{};{};{} (point)".format(lvl1_label, lvl2_label, lvl3_label))
-                                geo_list.append(geo)
-                                break
-
-                    finding_list_poly = list(glob(os.path.join(lvl3_path, "*_polygon.shp")))
-                    if len(finding_list_poly) > 0:
-                        poly_shp_path = finding_list_poly[0]
-                        gdf_landmark_poly = fiona.open(poly_shp_path)
-
-                        for next_shp in gdf_landmark_poly:
-                            geo = shape(next_shp['geometry'])
-                            if cluster_poly.intersects(geo):  # polygon intersects a polygon landmark
-                                poly_label_list.append("{};{};{} (polygon)".format(lvl1_label, lvl2_label, lvl3_label))
-                                geo_list.append(geo)
-                                break
+        for osm_label, geo in self._map_categories(functools.partial(self._find_category_in_shape, cluster_poly)):
+            if geo is None:
+                continue
+            if osm_label.endswith("(point)"):
+                point_label_list.append(osm_label)
+            else:
+                poly_label_list.append(osm_label)
+            geo_list.append(geo)
 
         result_json = {"matched_labels": point_label_list + list(set(poly_label_list) - set(point_label_list)),
                        "point_labels": point_label_list,
@@ -193,40 +378,19 @@ class SemanticAnnotator:
         cluster_centroid_point_p = cluster_centroid_point_p.to_crs('epsg:2163')
         cluster_centroid_point_p.reset_index(inplace=True, drop=True)
 
+        if self.index_snapshot is not None:
+            nearest_POI_list = [self._find_snapshot_nearest_poi(x, y) for x, y in
+                                zip(cluster_centroid_point_p.geometry.x, cluster_centroid_point_p.geometry.y)]
+            dataframe["matched_labels"] = [label for label, _ in nearest_POI_list]
+            dataframe["min_distance"] = [distance for _, distance in nearest_POI_list]
+            return dataframe
+
         dist2point_df = pd.DataFrame()
 
         # iterate through all level3 landmarks and find associated labels (lvl1, lvl2, lvl3)
-
-        for lvl1_label in tqdm(os.listdir(self.geofabrik_combined_folder_path)):
-            # print("Level 1 : " + lvl1_label)
-            lvl1_path = self.geofabrik_combined_folder_path + os.sep + lvl1_label
-            for lvl2_label in os.listdir(lvl1_path):
-                # print("  Level 2 : " + lvl2_label)
-                lvl2_path = lvl1_path + os.sep + lvl2_label
-                for lvl3_label in os.listdir(lvl2_path):
-                    # print("    Level 3 : " + lvl3_label)
-                    lvl3_path = lvl2_path + os.sep + lvl3_label
-
-                    finding_list_point = list(glob(os.path.join(lvl3_path, "*_point.shp")))
-                    if len(finding_list_point) > 0:
-                        point_shp_path = finding_list_point[0]
-
-                        gdf_landmark = gpd.read_file(point_shp_path)
-                        nearest_POI = dist.dist_to_point(cluster_centroid_point_p, gdf_landmark, proj=2163)
-                        dist2point_df["{};{};{} (point)".format(lvl1_label, lvl2_label, lvl3_label)] = \
-                            nearest_POI["dist2point"]
-
-                    finding_list_poly = list(glob(os.path.join(lvl3_path, "*_polygon.shp")))
-                    if len(finding_list_poly) > 0:
-                        poly_shp_path = finding_list_poly[0]
-
-                        gdf_landmark = gpd.read_file(poly_shp_path)
-                        gdf_landmark = gdf_landmark.to_crs('epsg:2163')
-                        gdf_landmark.geometry = gdf_landmark.geometry.centroid
-
-                        nearest_POI = dist.dist_to_point(cluster_centroid_point_p, gdf_landmark, proj=2163)
-                        dist2point_df["{};{};{} (polygon)".format(lvl1_label, lvl2_label, lvl3_label)] = \
-                            nearest_POI["dist2point"]
+        for osm_label, distances in self._map_categories(
+                functools.partial(self._get_category_distances, cluster_centroid_point_p)):
+            dist2point_df[osm_label] = distances
 
         nearest_POI_list = dist2point_df.idxmin(axis=1)
         nearest_POI_dist_list = dist2point_df.min(axis=1)
@@ -235,6 +399,117 @@ class SemanticAnnotator:
 
         return dataframe
 
+    def annotate_trajectory(self, dataframe, latitude_colname, longitude_colname, time_colname, user_colname=None,
+                            stay_radius=200, min_stay_duration=1200, reuse_radius=100):
+        """annotate time-ordered GPS trajectories with semantic labels from OpenStreetMap database.
+        Consecutive fixes that stay within stay_radius for at least min_stay_duration are collapsed into a stay point,
+            which is annotated once. The remaining (moving) fixes are annotated one by one.
+        With an index snapshot, each spatial query also caches the POIs around the query point that may be nearest
+            to any point within reuse_radius of it. The next fix within reuse_radius is matched against this cache only,
+            which gives the same result as a full query.
+        Without an index snapshot, stay points and moving fixes are annotated together with annotate_batch_points.
+
+        Parameters:
+            a dataframe with
+                latitude_colname: latitudes of the fixes, in degree
+                longitude_colname: longitudes of the fixes, in degree
+                time_colname: time of the fixes, datetime or seconds
+                user_colname (optional): user id of the fixes, each user is a separate track.
+                    Fixes without user id are treated as one more track.
+            stay_radius (float): maximal distance between fixes of a stay point, in meters
+            min_stay_duration (float): minimal duration of a stay point, in seconds
+            reuse_radius (float): maximal distance from the last spatial query to reuse its candidate POIs, in meters
+        Returns:
+           a dataframe with
+                stay_id: id of the stay point the fix belongs to, -1 for moving fixes
+                matched_labels: semantic labels matched with the fixes
+                min_distance: the distance from the fix (or its stay point) to the matched POI, in meters
+        """
+        if dataframe.shape[0] == 0:
+            return
+
+        track_df = dataframe.reset_index(drop=True)
+        fix_point_p = geodf.df_to_gdf(track_df, x=longitude_colname, y=latitude_colname)
+        fix_point_p = fix_point_p.to_crs('epsg:2163')
+        fix_x = fix_point_p.geometry.x.to_numpy(dtype=np.float64)
+        fix_y = fix_point_p.geometry.y.to_numpy(dtype=np.float64)
+
+        time_series = track_df[time_colname]
+        if pd.api.types.is_numeric_dtype(time_series):
+            fix_seconds = time_series.to_numpy(dtype=np.float64)
+        else:
+            time_series = pd.to_datetime(time_series)
+            fix_seconds = (time_series - time_series.min()).dt.total_seconds().to_numpy()
+
+        if user_colname is None:
+            track_list = [np.arange(track_df.shape[0])]
+        else:
+            # fixes with a missing user id get code -1 and form a track of their own
+            track_codes = pd.factorize(track_df[user_colname])[0]
+            track_order = np.argsort(track_codes, kind="stable")
+            track_list = np.split(track_order, np.flatnonzero(np.diff(track_codes[track_order])) + 1)
+
+        # collapse stays; a query is either a stay point or a moving fix, kept in time order per track
+        stay_id = np.full(track_df.shape[0], -1, dtype=np.int64)
+        query_x, query_y, query_track = [], [], []
+        fix_query = np.full(track_df.shape[0], -1, dtype=np.int64)
+        n_stays = 0
+        for track_num, track in enumerate(track_list):
+            track = track[np.argsort(fix_seconds[track], kind="stable")]
+            stay_idx, stay_points = self._detect_stay_points(fix_x[track], fix_y[track], fix_seconds[track],
+                                                             stay_radius, min_stay_duration)
+            last_stay = -1
+            for fix, idx in zip(track, stay_idx):
+                if idx < 0 or idx != last_stay:
+                    qx, qy = (fix_x[fix], fix_y[fix]) if idx < 0 else stay_points[idx]
+                    query_x.append(qx)
+                    query_y.append(qy)
+                    query_track.append(track_num)
+                fix_query[fix] = len(query_x) - 1
+                if idx >= 0:
+                    stay_id[fix] = n_stays + idx
+                last_stay = idx
+            n_stays += len(stay_points)
+
+        if self.index_snapshot is not None:
+            snapshot = self.index_snapshot
+            query_label_list = []
+            query_dist_list = []
+            anchor = None  # (track, x, y, candidate indices) of the last full query
+            for qx, qy, track_num in zip(query_x, query_y, query_track):
+                if anchor is not None and anchor[0] == track_num and \
+                        np.hypot(qx - anchor[1], qy - anchor[2]) <= reuse_radius:
+                    candidates = anchor[3]
+                    d = np.hypot(snapshot["x"][candidates] - qx, snapshot["y"][candidates] - qy)
+                    i = int(np.argmin(d))
+                    query_label_list.append(snapshot["labels"][int(snapshot["codes"][candidates[i]])])
+                    query_dist_list.append(float(d[i]))
+                    continue
+
+                label, distance = self._find_snapshot_nearest_poi(qx, qy)
+                query_label_list.append(label)
+                query_dist_list.append(distance)
+                anchor = None
+                if label is not None:
+                    # the nearest POI of any point within reuse_radius lies within distance + 2 * reuse_radius
+                    candidates = self._get_snapshot_candidates_within(qx, qy, distance + 2 * reuse_radius)
+                    if candidates is not None:
+                        anchor = (track_num, qx, qy, candidates)
+        else:
+            query_p = gpd.GeoDataFrame(geometry=gpd.points_from_xy(query_x, query_y), crs='epsg:2163')
+            query_p = query_p.to_crs('epsg:4326')
+            query_df = pd.DataFrame({"latitude": query_p.geometry.y, "longitude": query_p.geometry.x})
+            query_df = self.annotate_batch_points(query_df, "latitude", "longitude")
+            query_label_list = list(query_df["matched_labels"])
+            query_dist_list = list(query_df["min_distance"])
+
+        dataframe = dataframe.copy()
+        dataframe["stay_id"] = stay_id
+        dataframe["matched_labels"] = [query_label_list[q] for q in fix_query]
+        dataframe["min_distance"] = [query_dist_list[q] for q in fix_query]
+
+        return dataframe
+
 
 if __name__ == "__main__":
     geofabrik_combined_folder_path = sys.argv[1]